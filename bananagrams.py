@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
 
+import argparse
 import copy
+import contextlib
+import hashlib
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
 
 
 LEFT_RIGHT = True
@@ -267,16 +275,147 @@ def presorted_dict(words):
     return my_dict
 
 
-def add_word(bag, board, my_dict):
-    """Add one word to the board using given letters."""
+class RackCache:
+    """An on-disk cache of opening words, backed by sqlite
+
+    Entries are keyed by the lexicon version and the sorted rack, so the same
+    letters in any order share one entry. Each entry holds the opening word
+    for that rack; the leftover letters depend on the order of the caller's
+    rack and are worked out from it.
+
+    The database may be shared by several processes. Each operation opens its
+    own connection and runs in a single `BEGIN IMMEDIATE` transaction, so
+    sqlite's locking serializes them. Once the cache holds more than
+    `max_entries` racks for its lexicon the least recently used of them are
+    evicted; entries for other lexicon versions in the same file are left
+    alone. Recency is a counter bumped on every `get` hit and `put`.
+
+    path (str)        : sqlite database file
+    lexicon (str)     : version of the dictionary, see `lexicon_version`
+    max_entries (int) : maximum number of racks to keep for this lexicon
+    timeout (float)   : seconds to wait on a locked database
+
+    """
+    def __init__(self, path, lexicon, max_entries=10000, timeout=30.0):
+        if max_entries < 1:
+            raise BanagramsException("max_entries must be at least 1")
+        self.path = path
+        self.lexicon = lexicon
+        self.max_entries = max_entries
+        self.timeout = timeout
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+        finally:
+            conn.close()
+        with self._transaction() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS racks (
+                                lexicon TEXT NOT NULL,
+                                rack TEXT NOT NULL,
+                                word TEXT NOT NULL,
+                                last_used INTEGER NOT NULL,
+                                PRIMARY KEY (lexicon, rack))""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS racks_lexicon_last_used
+                            ON racks (lexicon, last_used)""")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Yields a connection inside a write transaction
+
+        The transaction is committed if the block succeeds and rolled back
+        otherwise.
+
+        """
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def _next_use(self, conn):
+        """Returns a recency value newer than any in this lexicon"""
+        return conn.execute(
+            'SELECT COALESCE(MAX(last_used), 0) + 1 FROM racks '
+            'WHERE lexicon = ?', (self.lexicon,)).fetchone()[0]
+
+    def get(self, letters):
+        """Returns the opening word for the rack, or None if not cached"""
+        rack = sort_word(letters)
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT word FROM racks WHERE lexicon = ? AND rack = ?',
+                (self.lexicon, rack)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                'UPDATE racks SET last_used = ? '
+                'WHERE lexicon = ? AND rack = ?',
+                (self._next_use(conn), self.lexicon, rack))
+        return row[0]
+
+    def put(self, letters, word):
+        """Stores the opening word for the rack"""
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO racks '
+                '(lexicon, rack, word, last_used) '
+                'VALUES (?, ?, ?, ?)',
+                (self.lexicon, sort_word(letters), word,
+                 self._next_use(conn)))
+            conn.execute(
+                'DELETE FROM racks WHERE rowid IN ('
+                'SELECT rowid FROM racks WHERE lexicon = ? '
+                'ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.lexicon, self.max_entries))
+
+    def __len__(self):
+        with self._transaction() as conn:
+            return conn.execute('SELECT COUNT(*) FROM racks WHERE lexicon = ?',
+                                (self.lexicon,)).fetchone()[0]
+
+
+def lexicon_version(my_dict):
+    """Returns a string that identifies the contents of a dictionary
+
+    my_dict ({str : [str]}) : dictionary of letter sets->words
+
+    """
+    digest = hashlib.sha1()
+    for code in sorted(my_dict):
+        digest.update('{}:{}\n'.format(code, ','.join(my_dict[code]))
+                      .encode('utf-8'))
+    return digest.hexdigest()
+
+
+def add_word(bag, board, my_dict, cache=None):
+    """Add one word to the board using given letters.
+
+    The opening word for an empty board is solved for the sorted rack, so every
+    ordering of the same letters gets the same word. If a RackCache is given,
+    that word is looked up there first and stored there after being found.
+
+    """
     if not board.grid:
-        words = get_longest_word(bag, my_dict)
+        word = cache.get(bag) if cache is not None else None
+        if word is not None:
+            return board.add_first_word(word), subtract_word(bag, word)
+        words = get_longest_word(sort_word(bag), my_dict)
         if not words:
             raise BanagramsException(
                 "Coudln't find a word containing letters", bag)
         word = words[0]
         new_board = board.add_first_word(word)
         remaining_letters = subtract_word(bag, word)
+        if cache is not None:
+            cache.put(bag, word)
         # print('remaining_letters({}, {}) = "{}"'.format(bag, word,
         #                                                 remaining_letters))
         return new_board, remaining_letters
@@ -467,9 +606,12 @@ def findOccurences(s, ch):
     return (i for i, letter in enumerate(s) if letter == ch)
 
 
-def interactive():
+def interactive(cache_path=None, cache_size=10000):
     print(welcome_msg())
     d = create_dict()
+    cache = None
+    if cache_path:
+        cache = RackCache(cache_path, lexicon_version(d), cache_size)
     b = Board()
     input_letters = parse_input(input())
     remaining, remaining_last = input_letters, None
@@ -479,7 +621,7 @@ def interactive():
             # print('board: {}, remaining: {} ({})'.format(
             #     repr(b), remaining, type(remaining)))
             remaining_last = remaining
-            b, remaining = add_word(remaining, b, d)
+            b, remaining = add_word(remaining, b, d, cache)
         if remaining:
             print(couldnt_place_msg(remaining))
         print('\nBoard:\n\n{}\n'.format(b))
@@ -625,9 +767,78 @@ def remove_test():
     print()
 
 
+def _rack_cache_worker(args):
+    path, worker = args
+    cache = RackCache(path, 'shared', max_entries=5)
+    for i in range(50):
+        rack = 'abcdefghij'[(worker + i) % 10] * 3
+        if cache.get(rack) is None:
+            cache.put(rack, rack)
+    return len(cache)
+
+
+def rack_cache_test():
+    my_dict = create_dict()
+    lexicon = lexicon_version(my_dict)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'racks.db')
+
+        # A cache, hit or miss, gives the same board and leftovers as none
+        cache = RackCache(path, lexicon)
+        shuffler = random.Random(0)
+        for rack in ['prtegcd', 'dehanig', 'neoatis', 'stanrei']:
+            for i in range(6):
+                letters = list(rack)
+                shuffler.shuffle(letters)
+                letters = ''.join(letters)
+                cold, cold_remaining = add_word(letters, Board(), my_dict)
+                hit, hit_remaining = add_word(letters, Board(), my_dict,
+                                              cache)
+                if str(cold) != str(hit) or cold_remaining != hit_remaining:
+                    raise Exception("Cache changed the answer for " + letters)
+        if len(cache) != 4:
+            raise Exception("Permuted racks should share one entry")
+
+        # Only max_entries racks are kept, least recently used go first
+        small = RackCache(path, 'small', max_entries=2)
+        small.put('cat', 'cat')
+        small.put('dog', 'dog')
+        small.get('act')
+        small.put('pig', 'pig')
+        if len(small) != 2 or small.get('dog') is not None or \
+           small.get('cat') is None or small.get('pig') is None:
+            raise Exception("Didn't evict least recently used rack")
+        if len(cache) != 4:
+            raise Exception("Evicted racks from another lexicon")
+
+        # A different lexicon version doesn't hit
+        if RackCache(path, 'other').get('dehanig') is not None:
+            raise Exception("Cache hit across lexicon versions")
+
+        # Several processes can share one file
+        RackCache(path, 'shared', max_entries=5)
+        with multiprocessing.Pool(4) as pool:
+            sizes = pool.map(_rack_cache_worker,
+                             [(path, worker) for worker in range(8)])
+        if max(sizes) > 5 or len(RackCache(path, 'shared')) != 5:
+            raise Exception("Shared cache grew past max_entries")
+    print('rack_cache_test passed')
+
+
 def main():
-    remove_test()
-    # interactive()
+    parser = argparse.ArgumentParser(description='The Bananagrams machine')
+    parser.add_argument('--play', action='store_true',
+                        help='play interactively instead of running tests')
+    parser.add_argument('--cache', metavar='PATH',
+                        help='sqlite file to cache opening words in')
+    parser.add_argument('--cache-size', type=int, default=10000,
+                        help='maximum number of racks to cache')
+    args = parser.parse_args()
+    if args.play:
+        interactive(args.cache, args.cache_size)
+    else:
+        remove_test()
+        rack_cache_test()
 
 
 if __name__ == '__main__':